@@ -58,6 +58,21 @@ export default function Dashboard() {
     if (res.ok) setHistory(await res.json());
   }
 
+  // PDFs are built in the background; poll until the signed URL is ready
+  async function waitForPdf(token: string, jobId: string): Promise<string> {
+    for (let attempt = 0; attempt < 60; attempt++) {
+      const res = await fetch(`${BACKEND}/pdf/${jobId}`, {
+        headers: { Authorization: `Bearer ${token}` },
+      });
+      if (!res.ok) throw new Error('PDF lookup failed');
+      const data = await res.json();
+      if (data.status === 'ready') return data.url;
+      if (data.status === 'failed') throw new Error('PDF generation failed');
+      await new Promise((resolve) => setTimeout(resolve, 1000));
+    }
+    throw new Error('PDF generation timed out');
+  }
+
   // ── init ─────────────────────────────────────────────────────────────────
 
   useEffect(() => {
@@ -116,20 +131,20 @@ export default function Dashboard() {
         alert(`Error: ${err.detail}`); return;
       }
 
-      // trigger PDF download
-      const blob = await res.blob();
-      const url  = URL.createObjectURL(blob);
-      const a    = document.createElement('a');
-      a.href     = url;
-      a.download = `quotes-${(bookTitle || 'analysis').replace(/\s+/g, '-').toLowerCase()}.pdf`;
-      document.body.appendChild(a);
-      a.click();
-      document.body.removeChild(a);
-      URL.revokeObjectURL(url);
-
-      // refresh profile (usage_count) and history
-      const t = await getToken();
-      await Promise.all([fetchProfile(t), fetchHistory(t)]);
+      // trigger PDF download (the signed URL sets the attachment filename)
+      const { pdf_job_id } = await res.json();
+      try {
+        const url = await waitForPdf(token, pdf_job_id);
+        const a   = document.createElement('a');
+        a.href    = url;
+        document.body.appendChild(a);
+        a.click();
+        document.body.removeChild(a);
+      } finally {
+        // refresh profile (usage_count) and history; a failed PDF is refunded
+        const t = await getToken();
+        await Promise.all([fetchProfile(t), fetchHistory(t)]);
+      }
     } catch {
       alert('Something went wrong. Please try again.');
     } finally {
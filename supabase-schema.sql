@@ -24,6 +24,9 @@ create table if not exists public.quote_generations (
   author       text,
   input_text   text,
   quotes_data  jsonb,
+  pdf_path     text,
+  pdf_error    text,
+  batch_id     text,
   created_at   timestamptz default now() not null
 );
 
@@ -77,3 +80,118 @@ drop trigger if exists update_profiles_updated_at on public.profiles;
 create trigger update_profiles_updated_at
   before update on public.profiles
   for each row execute procedure public.update_updated_at();
+
+-- 6. Reserve a generation before any LLM spend: paywall check, usage
+--    increment and history insert run atomically under a row lock, in one
+--    round-trip. The backend fills in quotes_data (or batch_id) afterwards.
+--    Errors use PostgREST's PTxxx codes so they map to HTTP statuses.
+drop function if exists public.record_generation(uuid, text, text, text, text, jsonb);
+drop function if exists public.record_generation(uuid, text, text, text, text, jsonb, text);
+
+create or replace function public.reserve_generation(
+  p_user_id    uuid,
+  p_input_type text,
+  p_book_title text,
+  p_author     text,
+  p_input_text text
+)
+returns uuid as $$
+declare
+  v_profile public.profiles;
+  v_id      uuid;
+begin
+  select * into v_profile
+  from public.profiles
+  where id = p_user_id
+  for update;
+
+  if not found then
+    raise sqlstate 'PT404' using message = 'Profile not found';
+  end if;
+
+  -- Free tier = 1 generation
+  if v_profile.usage_count >= 1 and not v_profile.is_subscribed then
+    raise sqlstate 'PT402' using message = 'Free tier limit reached';
+  end if;
+
+  insert into public.quote_generations
+    (user_id, input_type, book_title, author, input_text)
+  values
+    (p_user_id, p_input_type, p_book_title, p_author, p_input_text)
+  returning id into v_id;
+
+  update public.profiles
+  set usage_count = usage_count + 1
+  where id = p_user_id;
+
+  return v_id;
+end;
+$$ language plpgsql security definer;
+
+-- Undo a reservation whose generation never produced quotes: drop the row
+-- and refund the usage it took.
+create or replace function public.release_generation(p_generation_id uuid)
+returns void as $$
+declare
+  v_user_id uuid;
+begin
+  delete from public.quote_generations
+  where id = p_generation_id
+  returning user_id into v_user_id;
+
+  if found then
+    update public.profiles
+    set usage_count = greatest(usage_count - 1, 0)
+    where id = v_user_id;
+  end if;
+end;
+$$ language plpgsql security definer;
+
+-- Only the backend (service role) may reserve or release generations
+revoke execute on function public.reserve_generation(uuid, text, text, text, text)
+  from public, anon, authenticated;
+revoke execute on function public.release_generation(uuid)
+  from public, anon, authenticated;
+
+-- 7. Generated PDFs: built in the background and stored privately under
+--    pdfs/<user_id>/<generation_id>.pdf; the backend hands out signed URLs.
+--    pdf_error is set instead when the background build fails.
+alter table public.quote_generations add column if not exists pdf_path text;
+alter table public.quote_generations add column if not exists pdf_error text;
+
+insert into storage.buckets (id, name, public)
+values ('pdfs', 'pdfs', false)
+on conflict (id) do nothing;
+
+-- 8. Async generations: quotes_data stays null until the OpenAI batch
+--    recorded in batch_id completes and the backend fills it in.
+alter table public.quote_generations add column if not exists batch_id text;
+
+-- A generation whose batch or PDF build fails keeps its row, marked failed
+-- through pdf_error, and the usage it reserved is refunded.
+create or replace function public.fail_generation(p_generation_id uuid, p_error text)
+returns void as $$
+declare
+  v_user_id uuid;
+begin
+  update public.quote_generations
+  set pdf_error = p_error
+  where id = p_generation_id and pdf_error is null
+  returning user_id into v_user_id;
+
+  if found then
+    update public.profiles
+    set usage_count = greatest(usage_count - 1, 0)
+    where id = v_user_id;
+  end if;
+end;
+$$ language plpgsql security definer;
+
+revoke execute on function public.fail_generation(uuid, text)
+  from public, anon, authenticated;
+
+-- 9. History is paged newest-first per user with a created_at cursor;
+--    this index serves it without a sort or a heap lookup.
+create index if not exists quote_generations_user_created_idx
+  on public.quote_generations (user_id, created_at desc)
+  include (id, input_type, book_title, author);